@@ -1,28 +1,78 @@
 from fastapi import FastAPI, HTTPException, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-import requests
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
+import httpx
+import orjson
 import math
+import numpy as np
 import os
 import io
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlencode, quote
 from dotenv import load_dotenv
-from google.cloud import storage # <--- NEW LIBRARY
 
 # --- APP SETUP ---
-app = FastAPI() 
+# Newer FastAPI serializes responses natively and deprecates ORJSONResponse,
+# so only opt into it where it is still supported
+if getattr(ORJSONResponse, "__deprecated__", None):
+    app = FastAPI()
+else:
+    app = FastAPI(default_response_class=ORJSONResponse)
 load_dotenv()
 
 # --- GCS CONFIGURATION ---
 # Replace 'transit-safe-evidence' with your ACTUAL bucket name if different
 GCS_BUCKET_NAME = "transit-safe-evidence" 
 
-# Initialize GCS Client
+# Uploads larger than this go up as a resumable upload in chunks of this size.
+# This caps memory per upload (the client buffers one chunk at a time, 100 MiB by
+# default); it trades a few extra sequential requests for that, not throughput.
+# (must be a multiple of 256 KiB)
+GCS_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Reject evidence uploads larger than this (in MB) before touching the bucket
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "50"))
+# Whole-request limit checked against Content-Length; the slack covers the
+# multipart boundaries and the run_number/gps form fields
+MAX_UPLOAD_BODY_BYTES = MAX_UPLOAD_MB * 1024 * 1024 + 64 * 1024
+
+# GCS Client is created on first upload so google-cloud-storage is only
+# imported when evidence is actually submitted
 # (Google Cloud Run handles authentication automatically via Service Account)
-try:
-    storage_client = storage.Client()
-except Exception as e:
-    print(f"Error initializing GCS client: {e}")
+storage_client = None
+
+def get_storage_client():
+    global storage_client
+    if storage_client is None:
+        from google.cloud import storage
+        storage_client = storage.Client()
+    return storage_client
+
+# --- UPLOAD SIZE GUARD ---
+# Plain ASGI middleware (no per-request overhead for other routes) that turns away
+# oversized /submit-report bodies from Content-Length, before the form is read
+# and spooled to disk. The file.size check in submit_report stays as the backstop
+# for requests without a Content-Length.
+class UploadSizeLimit:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/submit-report":
+            for name, value in scope["headers"]:
+                if name == b"content-length" and value.isdigit() and int(value) > MAX_UPLOAD_BODY_BYTES:
+                    response = JSONResponse(
+                        {"detail": f"File too large (max {MAX_UPLOAD_MB} MB)."}, status_code=413
+                    )
+                    await response(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimit)
 
 # --- CORS ---
 app.add_middleware(
@@ -37,15 +87,47 @@ app.add_middleware(
 CTA_API_KEY = os.getenv("CTA_API_KEY")
 BASE_URL = "http://lapi.transitchicago.com/api/1.0/ttpositions.aspx"
 
+# CTA positions only refresh every ~20-30s, so cache per-route responses briefly
+CTA_CACHE_TTL = float(os.getenv("CTA_CACHE_TTL", "15"))
+
 if not CTA_API_KEY:
     print("WARNING: CTA_API_KEY not found. Train tracking will fail.")
 
+# Static query params are encoded once; only the route is appended per request
+CTA_URL_PREFIX = f"{BASE_URL}?{urlencode({'key': CTA_API_KEY or '', 'outputType': 'JSON'})}&rt="
+
+@functools.lru_cache(maxsize=32)
+def cta_url(route):
+    return CTA_URL_PREFIX + quote(route, safe='')
+
+# Shared async HTTP client for CTA calls (created on startup, reused across requests)
+http_client = None
+
+@app.on_event("startup")
+async def startup():
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    # Bounded pool for blocking storage I/O so uploads never stall the event loop
+    app.state.executor = ThreadPoolExecutor(max_workers=(2 * (os.cpu_count() or 1)) + 1)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
+    app.state.executor.shutdown(wait=True)
+
+# index.html never changes at runtime, so read it once at import
+try:
+    with open("index.html", "r", encoding="utf-8") as f:
+        INDEX_HTML = f.read()
+except FileNotFoundError:
+    INDEX_HTML = "Error: index.html not found."
+
 @app.get("/", response_class=HTMLResponse)
 def read_root():
-    if os.path.exists("index.html"):
-        with open("index.html", "r", encoding="utf-8") as f:
-            return f.read()
-    return "Error: index.html not found."
+    return INDEX_HTML
 
 # --- NEW: GOOGLE CLOUD UPLOAD ENDPOINT ---
 @app.post("/submit-report")
@@ -54,19 +136,30 @@ async def submit_report(
     run_number: str = Form(...),
     gps: str = Form(...)
 ):
+    if file.size and file.size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB} MB).")
+
     # 1. Generate unique filename
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     blob_name = f"reports/{timestamp}_RUN{run_number}.jpg"
     
     try:
-        # 2. Get the bucket
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
+        # 2. Get the bucket (client setup can hit the metadata server, so keep it off the loop)
+        loop = asyncio.get_running_loop()
+        client = await loop.run_in_executor(app.state.executor, get_storage_client)
+        bucket = client.bucket(GCS_BUCKET_NAME)
         blob = bucket.blob(blob_name)
 
         # 3. Upload from file stream
         # Rewind file to start just in case
         await file.seek(0)
-        blob.upload_from_file(file.file, content_type=file.content_type)
+        if file.size and file.size > GCS_CHUNK_SIZE:
+            blob.chunk_size = GCS_CHUNK_SIZE
+        # Upload is blocking, so run it on the storage thread pool
+        await loop.run_in_executor(
+            app.state.executor,
+            functools.partial(blob.upload_from_file, file.file, size=file.size, content_type=file.content_type),
+        )
         
         # 4. Generate the public link
         file_url = f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{blob_name}"
@@ -78,24 +171,76 @@ async def submit_report(
         raise HTTPException(status_code=500, detail=f"Upload Failed: {e}")
 
 # --- EXISTING TRAIN LOGIC ---
-def calculate_distance(lat1, lon1, lat2, lon2):
+def calculate_distances(lat, lon, lats, lons):
+    # Vectorized Haversine: distance from one point to arrays of points in one pass
     R = 6371000
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    # User-point terms are the same for every train, so compute them once as plain floats
+    user_phi = math.radians(lat)
+    user_cos = math.cos(user_phi)
+    user_lon_rad = math.radians(lon)
+
+    phi2 = np.radians(lats)
+    dphi = phi2 - user_phi
+    dlambda = np.radians(lons) - user_lon_rad
+    # sin^2(x/2) == (1 - cos(x)) / 2, so the whole expression only needs np.cos
+    a = 0.5 * (1 - np.cos(dphi)) + user_cos * np.cos(phi2) * 0.5 * (1 - np.cos(dlambda))
+    c = 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
     return R * c
 
-@app.get("/find-train/{route}")
-def find_user_train(route: str, lat: float, lon: float):
-    try:
-        response = requests.get(BASE_URL, params={"key": CTA_API_KEY, "rt": route, "outputType": "JSON"})
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Failed to connect to CTA: {str(e)}")
+# --- CTA RESPONSE CACHE ---
+# route -> (expires_at, data). Only successful responses are stored, so entries
+# stay bounded by the handful of real CTA lines.
+route_cache = {}
+# route -> asyncio.Future for a fetch in progress (coalesces concurrent misses,
+# including failures, so an outage costs one upstream call rather than one per waiter)
+route_inflight = {}
+route_lock = asyncio.Lock()
+
+async def fetch_route(route):
+    while True:
+        async with route_lock:
+            cached = route_cache.get(route)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            future = route_inflight.get(route)
+            is_leader = future is None
+            if is_leader:
+                future = asyncio.get_running_loop().create_future()
+                route_inflight[route] = future
+
+        if not is_leader:
+            # Another request is already fetching this route; share its result or error
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    # The leader was cancelled before finishing; try again
+                    continue
+                raise
 
+        try:
+            try:
+                response = await http_client.get(cta_url(route))
+                response.raise_for_status()
+                data = orjson.loads(response.content)
+            except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+                raise HTTPException(status_code=500, detail=f"Failed to connect to CTA: {str(e)}")
+
+            if not data.get('ctatt', {}).get('errNm'):
+                route_cache[route] = (time.monotonic() + CTA_CACHE_TTL, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the error as retrieved so it isn't logged when nobody was waiting
+            future.exception()
+            raise
+        finally:
+            del route_inflight[route]
+            if not future.done():
+                future.cancel()
+
+def nearest_trains(data, lat, lon, include_all=False):
     if data.get('ctatt', {}).get('errNm'):
         raise HTTPException(status_code=400, detail=f"CTA API Error: {data['ctatt']['errNm']}")
 
@@ -104,33 +249,97 @@ def find_user_train(route: str, lat: float, lon: float):
     except (KeyError, IndexError):
         return {"found": False, "message": "No trains found on this line right now."}
 
-    live_trains = []
-    
-    for t in raw_trains:
-        # Ghost Filter
-        if t.get('isSch', '0') == '0':
-            t_lat = float(t['lat'])
-            t_lon = float(t['lon'])
-            dist_meters = calculate_distance(lat, lon, t_lat, t_lon)
-            
-            live_trains.append({
-                "run_number": t['rn'],
-                "destination": t['destNm'],
-                "next_stop": t['nextStaNm'],
-                "lat": t_lat,
-                "lon": t_lon,
-                "distance_meters": round(dist_meters, 1)
-            })
-
-    live_trains.sort(key=lambda x: x['distance_meters'])
-
-    if live_trains:
-        closest = live_trains[0]
+    # Parse the CTA payload once into parallel lists, then hand them to NumPy in one go
+    lat_list = [float(t['lat']) for t in raw_trains]
+    lon_list = [float(t['lon']) for t in raw_trains]
+    is_ghost = np.array([t.get('isSch', '0') != '0' for t in raw_trains], dtype=bool)
+
+    distances = calculate_distances(lat, lon, np.array(lat_list), np.array(lon_list))
+    # Plain-float copy for building the response; indexing NumPy one scalar at a time is slow
+    dist_list = distances.tolist()
+
+    # Ghost Filter
+    live_idx = np.flatnonzero(~is_ghost)
+
+    if live_idx.size == 0:
+        return {"found": False, "message": "No live trains found."}
+
+    def train_info(i):
+        t = raw_trains[i]
+        return {
+            "run_number": t['rn'],
+            "destination": t['destNm'],
+            "next_stop": t['nextStaNm'],
+            "lat": lat_list[i],
+            "lon": lon_list[i],
+            "distance_meters": round(dist_list[i], 1)
+        }
+
+    if include_all:
+        # Every live train, ordered by distance (closest first)
+        order = live_idx[np.argsort(distances[live_idx])]
+        all_trains = [train_info(i) for i in order.tolist()]
+        closest = all_trains[0]
+    else:
+        # Only the closest train is returned, so materialize just that one
+        closest = train_info(int(live_idx[np.argmin(distances[live_idx])]))
+
+    result = {
+        "found": True,
+        "closest_train": closest,
+        "confidence": "High" if closest['distance_meters'] < 200 else "Low",
+    }
+    if include_all:
+        result["all_trains"] = all_trains
+    return result
+
+@app.get("/find-train/{route}")
+async def find_user_train(route: str, lat: float, lon: float, include_all: bool = False):
+    data = await fetch_route(route)
+    return nearest_trains(data, lat, lon, include_all)
+
+# CTA only runs 8 rail lines, so a batch never needs more than that
+MAX_BATCH_ROUTES = 8
+
+@app.get("/find-trains")
+async def find_user_trains(routes: str, lat: float, lon: float, include_all: bool = False):
+    route_list = list(dict.fromkeys(r.strip() for r in routes.split(',') if r.strip()))
+    if not route_list:
+        raise HTTPException(status_code=400, detail="No routes given.")
+    if len(route_list) > MAX_BATCH_ROUTES:
+        raise HTTPException(status_code=400, detail=f"Too many routes (max {MAX_BATCH_ROUTES}).")
+
+    # Fetch every route concurrently (cached routes return immediately)
+    fetched = await asyncio.gather(*[fetch_route(r) for r in route_list], return_exceptions=True)
+
+    results = {}
+    best = None
+    for route, data in zip(route_list, fetched):
+        # A failing route is reported on its own instead of failing the whole batch
+        if isinstance(data, HTTPException):
+            result = {"found": False, "message": data.detail}
+        elif isinstance(data, Exception):
+            result = {"found": False, "message": f"Failed to load route: {data}"}
+        elif isinstance(data, BaseException):
+            raise data
+        else:
+            try:
+                result = nearest_trains(data, lat, lon, include_all)
+            except HTTPException as e:
+                result = {"found": False, "message": e.detail}
+            except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                result = {"found": False, "message": f"Unexpected CTA response: {e}"}
+        results[route] = result
+
+        if result["found"] and (best is None or result["closest_train"]["distance_meters"] < best["distance_meters"]):
+            best = {**result["closest_train"], "route": route}
+
+    if best:
         return {
             "found": True,
-            "closest_train": closest,
-            "confidence": "High" if closest['distance_meters'] < 200 else "Low",
-            "all_trains": live_trains 
+            "closest_train": best,
+            "confidence": "High" if best['distance_meters'] < 200 else "Low",
+            "routes": results
         }
-    
-    return {"found": False, "message": "No live trains found."}
+
+    return {"found": False, "message": "No live trains found.", "routes": results}